@@ -219,6 +219,23 @@ class Xapian(object):
         obj = obj or kwargs
         self._index(obj, True, **kwargs)
 
+    def index_many(self, documents, commit=False):
+        by_endpoints = {}
+        for obj in documents:
+            result = index_parser(obj)
+            if not isinstance(result, tuple):
+                return result
+            endpoints, document = result
+            if not endpoints:
+                endpoints = self.active_endpoints
+            if not endpoints:
+                self._check_db()
+            by_endpoints.setdefault(endpoints, []).append(document)
+        reopen, self._do_reopen = self._do_reopen, False
+        for endpoints, documents in by_endpoints.items():
+            with self.databases_pool.database(endpoints, writable=True, create=self._do_create, reopen=reopen) as database:
+                database.index_many(documents, commit=commit)
+
     def commit(self):
         self._check_db()
         reopen, self._do_reopen = self._do_reopen, False
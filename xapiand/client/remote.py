@@ -199,6 +199,11 @@ class XapianConnection(Connection):
     def cindex(self, obj=None, **kwargs):
         return self._index('CINDEX', obj, **kwargs)
 
+    @command
+    def index_many(self, documents, commit=False):
+        documents = [dict((k, v) for k, v in document.items() if v) for document in documents]
+        return self._response(self.execute_command('CINDEX_MANY' if commit else 'INDEX_MANY', dumps(documents, ensure_ascii=False)))
+
     @command
     def commit(self):
         return self._response(self.execute_command('COMMIT'))
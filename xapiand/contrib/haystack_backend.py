@@ -1,5 +1,9 @@
 from __future__ import absolute_import, unicode_literals
 
+import re
+import base64
+import socket
+
 try:
     import cPickle as pickle
 except ImportError:
@@ -7,6 +11,7 @@ except ImportError:
 
 from xapiand import Xapian
 from xapiand.core import get_prefix, expand_terms, DOCUMENT_CUSTOM_TERM_PREFIX
+from xapiand.exceptions import XapianError, ConnectionError
 from xapiand.serialise import LatLongCoord
 from xapiand.results import XapianResults
 
@@ -28,6 +33,13 @@ except ImportError:
 DOCUMENT_TAGS_FIELD = 'tags'
 DOCUMENT_AC_FIELD = 'ac'
 
+UPDATE_BATCH_SIZE = 500
+
+QUERY_PLACEHOLDER_RE = re.compile(r'### AND ###|\(###\)')
+
+_CT_CACHE = {}
+_CT_FILTER_CACHE = {}
+
 
 class XapianSearchResults(XapianResults):
     def get_data(self, result):
@@ -36,8 +48,11 @@ class XapianSearchResults(XapianResults):
             # FIXME: Legacy data was not in base64 (REMOVE!)
             data = data.encode('utf-8')
         else:
-            data = data.decode('base64')
+            data = base64.b64decode(data)
         app_label, module_name, pk, model_data = pickle.loads(data)
+        # The model and pk fields come from the header, not stored twice:
+        model_data.setdefault(DJANGO_CT, '%s.%s' % (app_label, module_name))
+        model_data.setdefault(DJANGO_ID, '%s' % pk)
         return SearchResult(app_label, module_name, pk, result['weight'], **model_data)
 
 
@@ -77,6 +92,23 @@ class XapianSearchBackend(BaseSearchBackend):
         return self._xapian(*args, **kwargs)
 
     def updater(self, index, obj, commit):
+        document = self._prepare_document(index, obj)
+        if document:
+            self.index_documents([document], commit=commit)
+
+    def _prepare_document(self, index, obj):
+        try:
+            return self.prepare_document(index, obj)
+        except (TypeError, ValueError, pickle.PicklingError) as exc:
+            # Only this object's data is wrong, the rest still get indexed:
+            self.log.error("Failed to prepare document %s: %s", get_identifier(obj), exc, exc_info=True)
+
+    def prepare_document(self, index, obj):
+        """
+        Builds the document to be indexed for ``obj``, or None if it
+        shouldn't be indexed.
+
+        """
         if not obj.pk:
             return
 
@@ -84,31 +116,19 @@ class XapianSearchBackend(BaseSearchBackend):
         if not endpoints:
             return
 
+        schema = self.schema
+        content_field_name = self.content_field_name
         data = index.full_prepare(obj)
         weights = index.get_field_weights()
 
         document_values = {}
         document_terms = []
         document_texts = []
-        for field in self.schema:
+        add_term = document_terms.append
+        add_text = document_texts.append
+        for field in schema:
             field_name = field['field_name']
             if field_name in data:
-                if field_name in (ID, DJANGO_CT, DJANGO_ID):
-                    boolean = True
-                    prefix = get_prefix(field_name.upper(), DOCUMENT_CUSTOM_TERM_PREFIX)
-                else:
-                    boolean = field_name.lower() != field_name
-                    prefix = get_prefix(field_name, DOCUMENT_CUSTOM_TERM_PREFIX)
-                ac_prefix = get_prefix(DOCUMENT_AC_FIELD, DOCUMENT_CUSTOM_TERM_PREFIX)
-                tags_prefix = get_prefix(DOCUMENT_TAGS_FIELD, DOCUMENT_CUSTOM_TERM_PREFIX)
-                if boolean:
-                    term_case = lambda t: t
-                else:
-                    term_case = lambda t: t.lower()
-                prefix = term_case(prefix)
-                ac_prefix = term_case(ac_prefix)
-                tags_prefix = term_case(tags_prefix)
-
                 values = data[field_name]
                 if not field['multi_valued']:
                     values = [values]
@@ -116,30 +136,43 @@ class XapianSearchBackend(BaseSearchBackend):
                 if not field['stored']:
                     del data[field_name]
 
-                try:
-                    weight = int(weights[field_name])
-                except KeyError:
-                    weight = 1
+                values = [value for value in values if value]
+                if not values:
+                    continue
+
+                prefix = field['prefix']
+                if field['boolean']:
+                    term_case = lambda t: t
+                else:
+                    term_case = lambda t: t.lower()
+
+                weight = int(weights.get(field_name, 1))
 
                 field_type = field['type']
-                for value in values:
-                    if not value:
-                        continue
+                mode = field['mode']  # mode = content, autocomplete, tagged
+                if field_type == 'text':
+                    if mode == 'autocomplete':
+                        text_prefix = field['ac_prefix']
+                    elif mode == 'tagged':
+                        text_prefix = field['tags_prefix']
+                    else:
+                        text_prefix = prefix
 
+                for value in values:
                     if field_type == 'text':
-                        if field['mode'] == 'autocomplete':  # mode = content, autocomplete, tagged
-                            document_terms.append(dict(term=value.lower(), weight=weight, prefix=ac_prefix))
-                        elif field['mode'] == 'tagged':
-                            document_terms.append(dict(term=value, weight=weight, prefix=tags_prefix))
+                        if mode == 'autocomplete':
+                            add_term((value.lower(), weight, text_prefix))
+                        elif mode == 'tagged':
+                            add_term((value, weight, text_prefix))
                         else:
-                            document_texts.append(dict(text=value, weight=weight, prefix=prefix))
+                            add_text((value, weight, text_prefix))
 
                     elif field_type in ('ngram', 'edge_ngram'):
                         NGRAM_MIN_LENGTH = 1
                         NGRAM_MAX_LENGTH = 15
                         terms = _ngram_terms({value: weight}, min_length=NGRAM_MIN_LENGTH, max_length=NGRAM_MAX_LENGTH, split=field_type == 'edge_ngram')
                         for term, weight in terms.items():
-                            document_terms.append(dict(term=term_case(term), weight=weight, prefix=prefix))
+                            add_term((term_case(term), weight, prefix))
 
                     elif field_type == 'geo_point':
                         lat, _, lng = value.partition(',')
@@ -148,47 +181,89 @@ class XapianSearchBackend(BaseSearchBackend):
                         document_values[field_name] = value
 
                     elif field_type == 'boolean':
-                        document_terms.append(dict(term=1 if value else 0, weight=weight, prefix=prefix))
+                        add_term((1 if value else 0, weight, prefix))
 
                     elif field_type in ('integer', 'long'):
                         value = int(value)
                         document_values[field_name] = value
-                        document_terms.append(dict(term=value, weight=weight, prefix=prefix))
+                        add_term((value, weight, prefix))
 
                     elif field_type in ('float'):
                         value = float(value)
                         document_values[field_name] = value
-                        document_terms.append(dict(term=value, weight=weight, prefix=prefix))
+                        add_term((value, weight, prefix))
 
                     elif field_type in ('date'):
                         document_values[field_name] = value
-                        document_terms.append(dict(term=value, weight=weight, prefix=prefix))
+                        add_term((value, weight, prefix))
 
-                    if field_name == self.content_field_name:
+                    if field_name == content_field_name:
                         pass
 
-        document_data = pickle.dumps((obj._meta.app_label, obj._meta.module_name, obj.pk, data), protocol=pickle.HIGHEST_PROTOCOL).encode('base64')
+        cls = obj.__class__
+        try:
+            app_label, module_name, model_ct, term_prefix = _CT_CACHE[cls]
+        except KeyError:
+            app_label, module_name, model_ct, term_prefix = _CT_CACHE[cls] = (
+                obj._meta.app_label,
+                obj._meta.module_name,
+                get_model_ct(obj),
+                get_prefix(DJANGO_CT.upper(), DOCUMENT_CUSTOM_TERM_PREFIX),
+            )
+
+        # The model and pk are in the header already (get_data() puts these
+        # fields back), so they aren't pickled again with the data:
+        for field_name in (DJANGO_CT, DJANGO_ID):
+            data.pop(field_name, None)
+        document_data = base64.b64encode(pickle.dumps((app_label, module_name, obj.pk, data), protocol=pickle.HIGHEST_PROTOCOL))
 
-        term_prefix = get_prefix(DJANGO_CT.upper(), DOCUMENT_CUSTOM_TERM_PREFIX)
-        document_terms.append(dict(term=get_model_ct(obj), weight=0, prefix=term_prefix))
+        add_term((model_ct, 0, term_prefix))
 
         document_id = get_identifier(obj)
 
+        return dict(
+            id=document_id,
+            data=document_data,
+            terms=document_terms,
+            values=document_values,
+            texts=document_texts,
+            endpoints=endpoints,
+            positions=True,
+        )
+
+    def index_documents(self, documents, commit=False):
+        """
+        Sends all ``documents`` in a single INDEX_MANY command, using one
+        connection from the pool. If ``commit`` is set, the databases get
+        committed once after the whole batch is indexed.
+
+        A lost connection is logged once and raised (unless silently failing)
+        instead of being retried for every document.
+
+        """
         def callback(xapian):
-            return xapian.index(
-                id=document_id,
-                data=document_data,
-                terms=document_terms,
-                values=document_values,
-                texts=document_texts,
-                endpoints=endpoints,
-                positions=True,
-            )
+            try:
+                xapian.index_many(documents, commit=commit)
+            except (socket.error, ConnectionError) as exc:
+                if not self.silently_fail:
+                    raise
+                self.log.error("Failed to index %d documents: %s", len(documents), exc, exc_info=True)
+            except XapianError as exc:
+                # The server rejected the batch, the connection is still fine:
+                self.log.error("Failed to index %d documents: %s", len(documents), exc)
         async(self.xapian)(callback)
 
     def update(self, index, iterable, commit=False, mod=False):
+        documents = []
         for obj in iterable:
-            self.updater(index, obj, commit=commit)
+            document = self._prepare_document(index, obj)
+            if document:
+                documents.append(document)
+                if len(documents) >= UPDATE_BATCH_SIZE:
+                    self.index_documents(documents, commit=commit)
+                    documents = []
+        if documents:
+            self.index_documents(documents, commit=commit)
 
     def remove(self, obj, commit=False):
         endpoints = self.endpoints.for_write(instance=obj)
@@ -228,21 +303,14 @@ class XapianSearchBackend(BaseSearchBackend):
                 'hits': 0,
             }
 
-        facets = {
-            'fields': {},
-            'dates': {},
-            'queries': {},
-        }
-
         if models:
             if not terms:
                 terms = set()
-            terms.update('%s:%s.%s' % (DJANGO_CT.upper(), model._meta.app_label, model._meta.module_name) for model in models)
+            terms.update(_model_ct_filter(model) for model in models)
 
-        _query_string = None
-        while _query_string != query_string:
-            _query_string = query_string
-            query_string = _query_string.replace('### AND ###', '###').replace('(###)', '###')
+        replaced = True
+        while replaced:
+            query_string, replaced = QUERY_PLACEHOLDER_RE.subn('###', query_string)
         query_string = query_string.replace('###', '')
         hints = hints or {}
         endpoints = self.endpoints.for_read(models=models, **hints)
@@ -259,8 +327,11 @@ class XapianSearchBackend(BaseSearchBackend):
                 partials=partials,
             )
 
-        for facet in results.facets:
-            facets['fields'][facet['name']] = (facet['term'], facet['termfreq'])
+        facets = {
+            'fields': {f['name']: (f['term'], f['termfreq']) for f in results.facets},
+            'dates': {},
+            'queries': {},
+        }
 
         return {
             'results': results,
@@ -294,7 +365,7 @@ class XapianSearchBackend(BaseSearchBackend):
         ]
         column = len(schema_fields)
 
-        for field_name, field_class in sorted(fields.items(), key=lambda n: n[0]):
+        for field_name, field_class in sorted(fields.items()):
             if field_class.document is True:
                 content_field_name = field_class.index_fieldname
 
@@ -329,21 +400,30 @@ class XapianSearchBackend(BaseSearchBackend):
                 schema_fields.append(field_data)
                 column += 1
 
+        for field_data in schema_fields:
+            _add_field_prefixes(field_data)
+
         return (content_field_name, schema_fields)
 
+    def _setup_schema(self):
+        fields = connections[self.connection_alias].get_unified_index().all_searchfields()
+        self._content_field_name, self._schema = self.build_schema(fields)
+
     @property
     def schema(self):
-        if not hasattr(self, '_schema'):
-            fields = connections[self.connection_alias].get_unified_index().all_searchfields()
-            self._content_field_name, self._schema = self.build_schema(fields)
-        return self._schema
+        try:
+            return self._schema
+        except AttributeError:
+            self._setup_schema()
+            return self._schema
 
     @property
     def content_field_name(self):
-        if not hasattr(self, '_content_field_name'):
-            fields = connections[self.connection_alias].get_unified_index().all_searchfields()
-            self._content_field_name, self._schema = self.build_schema(fields)
-        return self._content_field_name
+        try:
+            return self._content_field_name
+        except AttributeError:
+            self._setup_schema()
+            return self._content_field_name
 
 
 class XapianSearchQuery(BaseSearchQuery):
@@ -358,52 +438,126 @@ class XapianSearchQuery(BaseSearchQuery):
         return kwargs
 
     def build_query(self):
-        self.partials = []
-        self.terms = set()
-        self.ranges = set()
+        # Created lazily by build_query_fragment(), only when needed:
+        self.partials = None
+        self.terms = None
+        self.ranges = None
         return super(XapianSearchQuery, self).build_query()
 
+    def _add_partial(self, partial):
+        if self.partials is None:
+            self.partials = []
+        self.partials.append(partial)
+
+    def _add_term(self, term):
+        if self.terms is None:
+            self.terms = set()
+        self.terms.add(term)
+
+    def _add_range(self, rng):
+        if self.ranges is None:
+            self.ranges = set()
+        self.ranges.add(rng)
+
     def build_query_fragment(self, field, filter_type, value):
-        if filter_type == 'contains':
-            value = '%s:%s' % (field, value)
-
-        elif filter_type == 'like':
-            self.partials.append(' '.join('%s:%s' % (field, v) for v in value.split()))
-            value = '###'
-
-        elif filter_type == 'exact':
-            if field == DOCUMENT_AC_FIELD:
-                self.partials.append(' '.join('%s:%s' % (field, v) for v in value.split()))
-                value = '###'
-            elif field == DOCUMENT_TAGS_FIELD:
-                self.terms.add(expand_terms(value, field))
-                value = '###'
-            else:
-                value = '%s:"%s"' % (field, value)
+        try:
+            handler = QUERY_FRAGMENT_HANDLERS[filter_type]
+        except KeyError:
+            return value
+        return handler(self, field, value)
+
+
+def _fragment_contains(query, field, value):
+    return '%s:%s' % (field, value)
+
+
+def _fragment_like(query, field, value):
+    query._add_partial(' '.join('%s:%s' % (field, v) for v in value.split()))
+    return '###'
+
 
-        elif filter_type == 'gte':
-            self.ranges.add((field, value, None))
-            value = '(%s:%s..)' % (field, value)
+def _fragment_exact(query, field, value):
+    if field == DOCUMENT_AC_FIELD:
+        query._add_partial(' '.join('%s:%s' % (field, v) for v in value.split()))
+        return '###'
+    elif field == DOCUMENT_TAGS_FIELD:
+        term = expand_terms(value, field)
+        query._add_term(term)
+        return '###'
+    return '%s:"%s"' % (field, value)
 
-        elif filter_type == 'gt':
-            self.ranges.add((field, None, value))
-            value = 'NOT %s' % '(%s:..%s)' % (field, value)
 
-        elif filter_type == 'lte':
-            self.ranges.add((field, None, value))
-            value = '(%s:..%s)' % (field, value)
+def _fragment_gte(query, field, value):
+    query._add_range((field, value, None))
+    return '(%s:%s..)' % (field, value)
 
-        elif filter_type == 'lt':
-            self.ranges.add((field, value, None))
-            value = 'NOT %s' % '(%s:%s..)' % (field, value)
 
-        elif filter_type == 'startswith':
-            value = '%s:%s*' % (field, value)
+def _fragment_gt(query, field, value):
+    query._add_range((field, None, value))
+    return 'NOT (%s:..%s)' % (field, value)
 
-        elif filter_type == 'in':
-            value = '(%s)' % ' OR '.join('%s:%s' % (field, v) for v in value)
 
-        return value
+def _fragment_lte(query, field, value):
+    query._add_range((field, None, value))
+    return '(%s:..%s)' % (field, value)
+
+
+def _fragment_lt(query, field, value):
+    query._add_range((field, value, None))
+    return 'NOT (%s:%s..)' % (field, value)
+
+
+def _fragment_startswith(query, field, value):
+    return '%s:%s*' % (field, value)
+
+
+def _fragment_in(query, field, value):
+    return '(%s)' % ' OR '.join('%s:%s' % (field, v) for v in value)
+
+
+QUERY_FRAGMENT_HANDLERS = {
+    'contains': _fragment_contains,
+    'like': _fragment_like,
+    'exact': _fragment_exact,
+    'gte': _fragment_gte,
+    'gt': _fragment_gt,
+    'lte': _fragment_lte,
+    'lt': _fragment_lt,
+    'startswith': _fragment_startswith,
+    'in': _fragment_in,
+}
+
+
+def _model_ct_filter(model):
+    try:
+        return _CT_FILTER_CACHE[model]
+    except KeyError:
+        ct_filter = _CT_FILTER_CACHE[model] = '%s:%s.%s' % (DJANGO_CT.upper(), model._meta.app_label, model._meta.module_name)
+        return ct_filter
+
+
+def _add_field_prefixes(field_data):
+    """
+    Adds the (already cased) term prefixes used when indexing the field.
+
+    """
+    field_name = field_data['field_name']
+    if field_name in (ID, DJANGO_CT, DJANGO_ID):
+        boolean = True
+        prefix = get_prefix(field_name.upper(), DOCUMENT_CUSTOM_TERM_PREFIX)
+    else:
+        boolean = field_name.lower() != field_name
+        prefix = get_prefix(field_name, DOCUMENT_CUSTOM_TERM_PREFIX)
+    ac_prefix = get_prefix(DOCUMENT_AC_FIELD, DOCUMENT_CUSTOM_TERM_PREFIX)
+    tags_prefix = get_prefix(DOCUMENT_TAGS_FIELD, DOCUMENT_CUSTOM_TERM_PREFIX)
+    if not boolean:
+        prefix = prefix.lower()
+        ac_prefix = ac_prefix.lower()
+        tags_prefix = tags_prefix.lower()
+    field_data['boolean'] = boolean
+    field_data['prefix'] = prefix
+    field_data['ac_prefix'] = ac_prefix
+    field_data['tags_prefix'] = tags_prefix
 
 
 class XapianEngine(BaseEngine):
@@ -431,16 +585,20 @@ def _ngram_terms(terms, min_length=1, min_length_percentage=0, max_length=20, sp
             for _term in _terms:
                 split_terms[_term] = max(split_terms.get(_term, 0), weight)
 
-    # Find all the substrings of the term (all digit terms treated differently):
+    # Find all the substrings of the term:
     final_terms = {}
+    get_weight = final_terms.get
     for term, weight in split_terms.items():
         term_len = len(term)
-        for i in range(term_len):
-            for j in range(i + 1, term_len + 1):
-                l = j - i
-                if l <= max_length and l >= min_length and l >= int(term_len * min_length_percentage):
-                    _term = term[i:j]
-                    _weight = int(float(weight * l) / term_len)
-                    final_terms[_term] = max(final_terms.get(_term, 0), _weight)
+        lo = max(min_length, int(term_len * min_length_percentage), 1)
+        hi = min(max_length, term_len)
+        if lo > hi:
+            continue
+        for l in range(lo, hi + 1):
+            # The weight of a substring only depends on its length:
+            _weight = int(float(weight * l) / term_len)
+            for _term in set([term[i:i + l] for i in range(term_len - l + 1)]):
+                if get_weight(_term, -1) < _weight:
+                    final_terms[_term] = _weight
 
     return final_terms
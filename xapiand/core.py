@@ -3,10 +3,13 @@ from __future__ import absolute_import, unicode_literals, print_function
 import os
 import re
 import time
+import random
 import logging
+import threading
 import subprocess
 from hashlib import md5
-from collections import deque
+from functools import wraps
+from collections import deque, OrderedDict
 from contextlib import contextmanager
 
 import gevent
@@ -15,15 +18,31 @@ from gevent.lock import RLock
 
 import xapian
 
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
 from .exceptions import XapianError, InvalidIndexError
 from .serialise import serialise_value, normalize
-from .utils import parse_url, build_url
+from .utils import parse_url, build_url, lru_cache
 from .platforms import pid_exists
 
 DATABASE_MAX_LIFE = 900  # 900 = stop writer after 15 minutes of inactivity
 DATABASE_SHORT_LIFE = max(DATABASE_MAX_LIFE - 60, DATABASE_MAX_LIFE - DATABASE_MAX_LIFE / 3, 0)
 
+MAX_UNUSED_DATABASES = 10  # idle databases kept per pool queue
+PINNED_DATABASES = 64  # most recently used read-only pool queues never timed out
+
 MIN_TCP_SERVER_PORTS = 100
+PID_CHECK_TTL = 0.5  # seconds a TCP server process is trusted to be alive between checks
+
+XAPIAN_MAX_RETRIES = 4
+XAPIAN_RETRY_DELAY = 0.1
+
+SPAWN_PROBE_MIN_DELAY = 0.01  # first retry connecting to a spawned server after 10ms
+SPAWN_PROBE_MAX_DELAY = 0.3
+SPAWN_PROBE_TIMEOUT = 1.5
 
 DOCUMENT_ID_TERM_PREFIX = 'Q'
 DOCUMENT_CUSTOM_TERM_PREFIX = 'X'
@@ -33,6 +52,12 @@ KEY_RE = re.compile(r'[_a-zA-Z][_a-zA-Z0-9]*')
 PREFIX_RE = re.compile(r'(?:([_a-zA-Z][_a-zA-Z0-9]*):)?("[-\w.]+"|[-\w.]+)')
 TERM_SPLIT_RE = re.compile(r'[^-\w.]')
 
+# Hash used to map field names to value slots: 'md5' (legacy) or 'xxhash'.
+# Existing indexes must keep the hash they were created with.
+XAPIAND_SLOT_HASH = os.environ.get('XAPIAND_SLOT_HASH', 'md5')
+if XAPIAND_SLOT_HASH == 'xxhash' and xxhash is None:
+    raise ImportError("XAPIAND_SLOT_HASH=xxhash requires the xxhash module")
+
 XAPIAN_PREFER_GLASS = True
 XAPIAN_TCPSRV = '/usr/local/bin/xapian-tcpsrv-1.3'
 if XAPIAN_PREFER_GLASS:
@@ -46,49 +71,71 @@ else:
 
 
 def find_terms(value, field=None):
-    for term_field, terms in PREFIX_RE.findall(value):
+    for match in PREFIX_RE.finditer(value):
+        term_field, terms = match.groups()
         if not term_field:
             term_field = field
         for term in TERM_SPLIT_RE.split(terms):
             yield term, term_field, terms
 
 
+@lru_cache(maxsize=4096)
 def expand_terms(value, field=None, connector=' AND '):
     all_terms = {}
     for term, term_field, terms in find_terms(value, None):
         if term_field is None or term_field.lower() == term_field:
-            all_terms.setdefault((term_field, terms), []).append(term)
-    replacements = []
+            key = (term_field, terms)
+            try:
+                all_terms[key].append(term)
+            except KeyError:
+                all_terms[key] = [term]
+    replacements = {}
     for (term_field, terms), terms_list in all_terms.items():
         if terms[0] == '"':
             terms_list = [terms]
         if term_field is None:
-            term_field = field
+            _term_field = field
             replace_ = terms
         else:
+            _term_field = term_field
             replace_ = '%s:%s' % (term_field, terms)
-        if term_field:
-            with_ = connector.join('%s:%s' % (term_field, t) for t in terms_list if t)
+        if _term_field:
+            with_ = connector.join('%s:%s' % (_term_field, t) for t in terms_list if t)
             if replace_ != with_:
-                replacements.append((replace_, with_, len(terms_list) > 1))
-    for replace_, with_, parenthesis in replacements:
-        if parenthesis and len(replacements) > 1:
+                replacements[(term_field, terms)] = (with_, len(terms_list) > 1)
+    if not replacements:
+        return value
+    parenthesize = len(replacements) > 1
+
+    def replace(match):
+        try:
+            with_, parenthesis = replacements[match.groups()]
+        except KeyError:
+            return match.group(0)
+        if parenthesis and parenthesize:
             with_ = '(' + with_ + ')'
-        value = value.replace(replace_, with_)
-    return value
+        return with_
+
+    # Rewrite all the terms in a single pass:
+    return PREFIX_RE.sub(replace, value)
 
 
+@lru_cache(maxsize=4096)
 def get_slot(name):
     if KEY_RE.match(name):
         _name = name.lower()
         if _name != name:
             _name = name.upper()
-        slot = int(md5(_name).hexdigest(), 16) & 0xffffffff
+        if XAPIAND_SLOT_HASH == 'xxhash':
+            slot = xxhash.xxh32(_name.encode('utf-8')).intdigest()
+        else:
+            slot = int(md5(_name).hexdigest(), 16) & 0xffffffff
         if slot == 0xffffffff:
             slot = 0xfffffffe  # max slot is 0xfffffffe
         return slot
 
 
+@lru_cache(maxsize=4096)
 def get_prefix(name, prefix=''):
     slot = get_slot(name)
     slot = '{:x}'.format(slot).upper()
@@ -105,27 +152,39 @@ def prefixed(term, prefix=''):
         return prefix + ':' + term
 
 
+SPAWN_POOL_SIZE = 10
+
+# gevent pools and sockets are bound to the hub of the thread that made
+# them, so the spawn pool and the xapiand clients are kept per thread:
+_spawn_local = threading.local()
+
+
 def _spawn_tcpservers(endpoints, data='.', log=logging):
     from . import Xapian
 
-    max_pool_size = 10
-
-    all_servers = {}
-    p = pool.Pool(max_pool_size)
+    try:
+        _spawn_pool = _spawn_local.pool
+        _xapiand_clients = _spawn_local.clients
+    except AttributeError:
+        _spawn_pool = _spawn_local.pool = pool.Pool(SPAWN_POOL_SIZE)
+        _xapiand_clients = _spawn_local.clients = {}
 
     def spawner(db, parse, data, log):
         scheme, hostname, port, username, password, path, query, query_dict = parse
         servers = '%s:%s' % (hostname, port or 8890)
-        xapiand = all_servers.setdefault(servers, Xapian(
-            servers,
-            max_pool_size=max_pool_size,
-            max_retries=0,
-            max_connect_retries=1,
-            socket_timeout=1,
-            weak=True,
-            socket_class=socket.socket,
-            sleep=gevent.sleep,
-        ))
+        try:
+            xapiand = _xapiand_clients[servers]
+        except KeyError:
+            xapiand = _xapiand_clients[servers] = Xapian(
+                servers,
+                max_pool_size=SPAWN_POOL_SIZE,
+                max_retries=0,
+                max_connect_retries=1,
+                socket_timeout=1,
+                weak=True,
+                socket_class=socket.socket,
+                sleep=gevent.sleep,
+            )
         time_, address = xapiand.spawn(db)
         server = TcpDatabase(db, None, address)
         server.time = time_
@@ -138,7 +197,7 @@ def _spawn_tcpservers(endpoints, data='.', log=logging):
             except InvalidIndexError as exc:
                 log.error("%s", exc)
 
-    jobs = [p.spawn(_port, db) for db in endpoints]
+    jobs = [_spawn_pool.spawn(_port, db) for db in endpoints]
     gevent.joinall(jobs)
 
 
@@ -149,7 +208,7 @@ def _xapian_subdatabase(subdatabases, db, writable, create, data='.', log=loggin
     try:
         database = subdatabases[(writable, key)]
         log.debug("%s %s: %s", "Writable endpoint" if writable else "Endpoint", "re-used" if create else "re-opened", database._db)
-        return database, False
+        return database, key, False
     except KeyError:
         if path[0] not in ('/', '.'):
             path = os.path.join(data, path)
@@ -158,7 +217,7 @@ def _xapian_subdatabase(subdatabases, db, writable, create, data='.', log=loggin
         elif scheme == 'xapian':
             if path:
                 try:
-                    server = tcpservers[db]
+                    server = tcpservers[build_url(*parse)]
                     if not server.active:
                         raise KeyError
                     hostname, port = server.address
@@ -172,7 +231,7 @@ def _xapian_subdatabase(subdatabases, db, writable, create, data='.', log=loggin
         subdatabases[(writable, key)] = database
 
         log.debug("%s %s: %s", "Writable endpoint" if writable else "Endpoint", "used" if create else "opened", database._db)
-        return database, True
+        return database, key, True
 
 
 def _xapian_database_open(path, writable, create, data='.', log=logging):
@@ -231,6 +290,7 @@ def _xapian_database(endpoints, writable, create, data='.', log=logging):
                 if not server.process:
                     raise KeyError
                 server.time = now
+                tcpservers.touch(db)
             except KeyError:
                 missing.append(db)
     _spawn_tcpservers(missing, data=data, log=log)
@@ -240,27 +300,30 @@ def _xapian_database(endpoints, writable, create, data='.', log=logging):
     else:
         database = xapian.Database()
 
-    databases = len(endpoints)
-    _all_databases = [None] * databases
-    _all_databases_config = [None] * databases
+    _all_databases = []
+    _all_databases_keys = []
+    _subdatabases = {}
+    db_names = []
 
     database._all_databases = _all_databases
-    database._all_databases_config = _all_databases_config
+    database._all_databases_keys = _all_databases_keys
+    database._writable = writable
+    database._create = create
     database._endpoints = endpoints
-    database._subdatabases = {}
+    database._subdatabases = _subdatabases
 
     database._closed = False
 
-    for subdatabase_number, db in enumerate(endpoints):
-        if database._all_databases[subdatabase_number] is None:
-            _database, _ = _xapian_subdatabase(database._subdatabases, db, writable, create, data, log)
-            database._all_databases[subdatabase_number] = _database
-            database._all_databases_config[subdatabase_number] = (db, writable, create)
-            if _database:
-                database.add_database(_database)
+    for db in endpoints:
+        _database, key, _ = _xapian_subdatabase(_subdatabases, db, writable, create, data, log)
+        _all_databases.append(_database)
+        _all_databases_keys.append(key)
+        if _database:
+            database.add_database(_database)
+            db_names.append(_database._db)
 
-    database._db = " ".join(d._db for d in database._all_databases if d)
-    num = len(database._all_databases)
+    database._db = " ".join(db_names)
+    num = len(_all_databases)
     log.debug("%s %s with %d endpoint%s", "Writable database" if writable else "Database", "used" if create else "opened", num, '' if num == 1 else 's')
     return database
 
@@ -278,30 +341,29 @@ def _xapian_spawn(address, path, writable=True, data='.', log=logging):
     try:
         process = subprocess.Popen(args, stdout=FNULL, stderr=subprocess.STDOUT)
         log.info("Spawned xapian TCP server for \"%s\": %s:%s (pid:%s)", path, address[0], address[1], process.pid)
-        # Try conncting...
-        retries = 0
-        max_retries = 4
+        # Try conncting, backing off exponentially (the server is usually
+        # listening within a few milliseconds):
+        connected = False
+        delay = SPAWN_PROBE_MIN_DELAY
+        deadline = time.time() + SPAWN_PROBE_TIMEOUT
         address = ('127.0.0.1' if address[0] == '0.0.0.0' else address[0], address[1])
-        while retries <= max_retries:
+        while True:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             sock.settimeout(0.1)
             try:
                 sock.connect(address)
-                break
+                connected = True
             except socket.error as exc:
                 if exc.errno == socket.EISCONN:
-                    break   # we're good
-                if exc.errno == socket.EINVAL:
-                    # we're doomed, recreate socket
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    sock.settimeout(0.1)
+                    connected = True  # we're good
             except Exception:
                 pass
-            gevent.sleep(0.3)
-            retries += 1
-        if retries <= max_retries:
             sock.close()
-        else:
+            if connected or time.time() >= deadline:
+                break
+            gevent.sleep(delay)
+            delay = min(delay * 2, SPAWN_PROBE_MAX_DELAY)
+        if not connected:
             log.error("Could not connect to spawned server!")
         return process
     except Exception as exc:
@@ -339,6 +401,7 @@ def xapian_spawn(db, spawner=_xapian_spawner, data='.', log=logging):
                 raise InvalidIndexError("Cannot spawn TCP server: %s" % exc)
     if server.process:
         server.time = time.time()
+        tcpservers.touch(db)
     return server.time, server.address
 
 
@@ -357,12 +420,73 @@ class CleanableObject(object):
         raise NotImplementedError
 
 
-class CleanablePool(dict):
+class CleanablePool(OrderedDict):
+    """
+    Pool of cleanable objects, kept in the order they were last touched so
+    the most recently used ones can be pinned.
+
+    """
     def __init__(self, *args, **kwargs):
+        self.pinned = kwargs.pop('pinned', 0)
+        self.pinnable_count = 0
         super(CleanablePool, self).__init__(*args, **kwargs)
         self.lock = RLock()
         self.time = time.time()
 
+    def __setitem__(self, key, value):
+        # Keep count of the pinnable objects as they come and go:
+        count = self.pinnable(key, value)
+        if key in self:
+            count -= self.pinnable(key, self[key])
+        super(CleanablePool, self).__setitem__(key, value)
+        self.pinnable_count += count
+
+    def __delitem__(self, key):
+        count = self.pinnable(key, self[key])
+        super(CleanablePool, self).__delitem__(key)
+        self.pinnable_count -= count
+
+    def clear(self):
+        super(CleanablePool, self).clear()
+        self.pinnable_count = 0
+
+    # pop() and popitem() are spelled out in terms of __delitem__ so the
+    # pinnable count stays right whatever OrderedDict implementation is used:
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def popitem(self, last=True):
+        if not self:
+            raise KeyError("dictionary is empty")
+        key = next(reversed(self) if last else iter(self))
+        return key, self.pop(key)
+
+    def touch(self, key):
+        """
+        Moves an object to the end of the pool, as the most recently used.
+
+        """
+        try:
+            self[key] = self.pop(key)
+        except KeyError:
+            pass
+
+    def pinnable(self, key, obj):
+        """
+        Tells if an object can be pinned (kept even after it times out, as
+        long as it's among the ``pinned`` most recently used ones).
+
+        """
+        return True
+
     def cleanup(self, timeout, data='.', log=logging):
         """
         Removes old timedout databases from the pool.
@@ -373,13 +497,25 @@ class CleanablePool(dict):
             return
 
         with self.lock:
-            cleanups = []
-            for key, obj in list(self.items()):
+            expired = []
+            keep = self.pinned if timeout else 0
+            pinnable = self.pinnable_count  # pinnable objects from here on
+            # Times don't necessarily follow the pool's order (spawned remote
+            # servers come with their own), so every object is checked:
+            for key in self:
+                obj = self[key]
+                if keep and self.pinnable(key, obj):
+                    pinnable -= 1
+                    if pinnable < keep:
+                        continue  # among the most recently used, pinned
                 if not obj.used and now - obj.time > timeout:
-                    cleanups.append(obj)
-                    del self[key]
+                    expired.append(key)
+            cleanups = [self.pop(key) for key in expired]
             self.time = now
 
+        self._cleanup(cleanups)
+
+    def _cleanup(self, cleanups):
         for obj in cleanups:
             obj.cleanup()
 
@@ -390,20 +526,37 @@ class TcpDatabase(CleanableObject):
         self.database = database
         self.process = process
         self.address = address
+        self.pid_alive = True
+        self.pid_checked = 0
 
     @property
     def active(self):
-        if self.process and not pid_exists(self.process.pid):
-            return False
-        if time.time() - self.time > DATABASE_SHORT_LIFE:
+        now = time.time()
+        if self.process:
+            if not self.pid_alive:
+                return False
+            if now - self.pid_checked > PID_CHECK_TTL:
+                self.pid_alive = pid_exists(self.process.pid)
+                self.pid_checked = now
+                if not self.pid_alive:
+                    return False
+        if now - self.time > DATABASE_SHORT_LIFE:
             return False
         return True
 
-    def cleanup(self, data='.', log=logging):
+    def cleanup(self, data='.', log=logging, ports=None):
+        """
+        Stops the TCP server process, releasing its port (or, if a ``ports``
+        list is given, adding the port to it so it can be released later).
+
+        """
         if not self.cleaned:
             if self.process:
                 self.process.kill()
-                tcpservers.release(self.address[1])
+                if ports is None:
+                    tcpservers.release(self.address[1])
+                else:
+                    ports.append(self.address[1])
                 log.info("Stopped xapian TCP server: %s:%s (pid:%s).", self.address[0], self.address[1], self.process.pid)
             self.cleaned = True
 
@@ -411,8 +564,19 @@ class TcpDatabase(CleanableObject):
 class DatabasesPoolQueue(CleanableObject):
     def __init__(self):
         super(DatabasesPoolQueue, self).__init__()
-        self.unused = deque()
+        self.unused = deque(maxlen=MAX_UNUSED_DATABASES)
         self.used = set()
+        self.opening = 0
+        # Databases are released from other (OS) threads, so waiters use a
+        # real condition; ``releases`` counts releases so a waiter can tell
+        # whether one happened since it last looked:
+        self.released = threading.Condition()
+        self.releases = 0
+
+    def notify_released(self):
+        with self.released:
+            self.releases += 1
+            self.released.notify_all()
 
     def cleanup(self, data='.', log=logging):
         if not self.cleaned:
@@ -421,36 +585,85 @@ class DatabasesPoolQueue(CleanableObject):
             self.cleaned = True
 
 
+_STEMMER_CACHE = {}
+
+
+def _get_stemmer(language):
+    try:
+        return _STEMMER_CACHE[language]
+    except KeyError:
+        stemmer = _STEMMER_CACHE[language] = xapian.Stem(language)
+        return stemmer
+
+
+@lru_cache(maxsize=1024)
+def _canonicalize(db):
+    return build_url(*parse_url(db.strip()))
+
+
 class DatabasesPool(CleanablePool):
     def __init__(self, *args, **kwargs):
         self.data = kwargs.pop('data', '.')
         self.log = kwargs.pop('log', logging)
+        self.max_total = kwargs.pop('max_total', None)
+        self.acquire_timeout = kwargs.pop('acquire_timeout', None)
+        kwargs.setdefault('pinned', PINNED_DATABASES)
         super(DatabasesPool, self).__init__(*args, **kwargs)
 
+    def pinnable(self, key, obj):
+        # Writable databases hold the write lock, and remote ones are bound
+        # to tcpservers that time out on their own; only pin local readers:
+        writable, endpoints = key
+        return not writable and all(db.startswith('file://') for db in endpoints)
+
     @contextmanager
     def database(self, endpoints, writable, create=False, reopen=False):
         """
         Returns a xapian.Database with multiple endpoints attached.
 
+        If the pool was given a ``max_total``, at most that many databases
+        are handed out at once for the same endpoints; callers wait for one
+        to be released (up to ``acquire_timeout`` seconds).
+
         """
         database = None
         new = False
-        endpoints = tuple(build_url(*parse_url(db.strip())) for db in endpoints)
-
-        with self.lock:
-            pool_queue = self.setdefault((writable, endpoints), DatabasesPoolQueue())
-            with pool_queue.lock:
-                try:
-                    database = pool_queue.unused.pop()
-                    pool_queue.used.add(database)
-                except IndexError:
-                    new = True
-                pool_queue.time = time.time()
+        endpoints = tuple(_canonicalize(db) for db in endpoints)
+
+        while True:
+            with self.lock:
+                pool_queue = self.setdefault((writable, endpoints), DatabasesPoolQueue())
+                self.touch((writable, endpoints))
+                with pool_queue.lock:
+                    try:
+                        database = pool_queue.unused.pop()
+                        pool_queue.used.add(database)
+                    except IndexError:
+                        if self.max_total and len(pool_queue.used) + pool_queue.opening >= self.max_total:
+                            releases = pool_queue.releases
+                        else:
+                            pool_queue.opening += 1
+                            new = True
+                    pool_queue.time = time.time()
+            if database or new:
+                break
+            with pool_queue.released:
+                if pool_queue.releases == releases:
+                    pool_queue.released.wait(self.acquire_timeout)
+                if pool_queue.releases == releases:
+                    raise XapianError("Timed out waiting for a database: %s" % " ".join(endpoints))
 
         try:
             if new:
-                database = Database(endpoints, writable, create, data=self.data, log=self.log)
-                pool_queue.used.add(database)
+                try:
+                    database = Database(endpoints, writable, create, data=self.data, log=self.log)
+                finally:
+                    with pool_queue.lock:
+                        pool_queue.opening -= 1
+                        if database:
+                            pool_queue.used.add(database)
+                        else:
+                            pool_queue.notify_released()  # failed, let a waiter open one instead
             if reopen:
                 database.reopen()
 
@@ -460,12 +673,15 @@ class DatabasesPool(CleanablePool):
             with pool_queue.lock:
                 if database:
                     pool_queue.used.discard(database)
-                    if len(pool_queue.unused) < 10:
-                        if not database.database._closed:
-                            pool_queue.unused.append(database)
-                    else:
-                        database.close()
+                    if not database.database._closed:
+                        unused = pool_queue.unused
+                        if len(unused) == unused.maxlen:
+                            unused[0].close()  # about to be evicted by append()
+                        unused.append(database)
                 pool_queue.time = time.time()
+            with self.lock:
+                self.touch((writable, endpoints))
+            pool_queue.notify_released()
 
 
 class TcpPool(CleanablePool):
@@ -491,9 +707,53 @@ class TcpPool(CleanablePool):
         with self.lock:
             self.used.discard(port)
             self.unused.append(port)
+
+    def release_many(self, ports):
+        with self.lock:
+            used = self.used
+            for port in ports:
+                used.discard(port)
+            self.unused.extend(ports)
+
+    def _cleanup(self, cleanups):
+        # Release the ports of all the stopped servers at once:
+        ports = []
+        for obj in cleanups:
+            obj.cleanup(ports=ports)
+        self.release_many(ports)
 tcpservers = TcpPool()
 
 
+def retry_xapian(refetch=False):
+    """
+    Decorates a Database method so it's retried when a network or database
+    error occurs, reopening the database between attempts (and backing off
+    exponentially, with some jitter, after the first couple of attempts).
+
+    If ``refetch`` is set, the first argument of the method is a document
+    which gets fetched again whenever the database is reopened anew.
+
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            t = 0
+            while True:
+                database = self.database
+                try:
+                    return func(self, *args, **kwargs)
+                except (xapian.NetworkError, xapian.DatabaseError) as exc:
+                    if t >= XAPIAN_MAX_RETRIES:
+                        raise XapianError(exc)
+                    elif t > 1:
+                        gevent.sleep(XAPIAN_RETRY_DELAY * 2 ** (t - 2) + random.uniform(0, XAPIAN_RETRY_DELAY / 2))
+                    if self.reopen(t > 1) != database and refetch:
+                        args = (self.get_document(args[0].get_docid()),) + args[1:]
+                t += 1
+        return wrapper
+    return decorator
+
+
 class Database(object):
     def __init__(self, endpoints, writable, create, data='.', log=logging):
         self.writable = writable
@@ -523,12 +783,8 @@ class Database(object):
             database.close()
 
         # Subdatabases cleanup:
-        for subdatabase in database._all_databases:
-            subdatabase_number = database._all_databases.index(subdatabase)
-            db, writable, create = database._all_databases_config[subdatabase_number]
-            scheme, hostname, port, username, password, path, query, query_dict = parse_url(db)
-            key = (scheme, hostname, port, username, password, path)
-
+        writable = database._writable
+        for subdatabase, key in zip(database._all_databases, database._all_databases_keys):
             # Remove subdatabase from pool
             _subdatabase = subdatabases.pop((writable, key), None)
             assert not _subdatabase or _subdatabase == subdatabase
@@ -603,17 +859,25 @@ class Database(object):
                     term_prefix = prefix
                 if boolean:
                     term = terms
+                # Same as prefixed(), with the prefix worked out once per field:
+                term_prefix = term_prefix.upper()
+                separator = ':' if term_prefix and term_prefix[-1] != ':' else ''
                 for term in serialise_value(term):
                     if term:
                         if not boolean:
                             term = term.lower()
+                        if separator and term[0].isupper():
+                            term = term_prefix + separator + term
+                        else:
+                            term = term_prefix + term
                         if position is None:
-                            document.add_term(prefixed(term, term_prefix), weight)
+                            document.add_term(term, weight)
                         else:
-                            document.add_posting(prefixed(term, term_prefix), position, weight)
+                            document.add_posting(term, position, weight)
                 if boolean:
                     break
 
+        term_generators = {}
         for text in document_texts or ():
             if isinstance(text, (tuple, list)):
                 text, weight, prefix, language, spelling, positions = (list(text) + [None] * 6)[:6]
@@ -628,13 +892,17 @@ class Database(object):
             positions = default_positions if positions is None else positions
             spelling = default_spelling if spelling is None else spelling
 
-            term_generator = xapian.TermGenerator()
-            term_generator.set_document(document)
-            if spelling:
-                term_generator.set_database(database)
-                term_generator.set_flags(xapian.TermGenerator.FLAG_SPELLING)
-            if language:
-                term_generator.set_stemmer(xapian.Stem(language))
+            try:
+                term_generator = term_generators[(language, spelling)]
+                term_generator.set_termpos(0)
+            except KeyError:
+                term_generator = term_generators[(language, spelling)] = xapian.TermGenerator()
+                term_generator.set_document(document)
+                if spelling:
+                    term_generator.set_database(database)
+                    term_generator.set_flags(xapian.TermGenerator.FLAG_SPELLING)
+                if language:
+                    term_generator.set_stemmer(_get_stemmer(language))
             if positions:
                 index_text = term_generator.index_text
             else:
@@ -643,19 +911,32 @@ class Database(object):
 
         return self.replace(document_id, document, commit=commit)
 
-    def replace(self, document_id, document, commit=False, _t=0):
+    def index_many(self, documents, commit=False, commit_every=1000):
+        """
+        Indexes several documents, committing once every ``commit_every``
+        documents (and once more at the end if ``commit`` is set) instead of
+        once per document.
+
+        """
+        docids = []
+        pending = 0
+        for document in documents:
+            docids.append(self.index(document))
+            pending += 1
+            if commit_every and pending >= commit_every:
+                self.commit()
+                pending = 0
+        if commit and pending:
+            self.commit()
+        return docids
+
+    @retry_xapian()
+    def replace(self, document_id, document, commit=False):
         database = self.database
         try:
             docid = database.replace_document(document_id, document)
         except xapian.InvalidArgumentError as exc:
             self.log.error("%s", exc)
-        except (xapian.NetworkError, xapian.DatabaseError) as exc:
-            if _t > 3:
-                raise XapianError(exc)
-            elif _t > 1:
-                gevent.sleep(0.1)
-            self.reopen(_t > 1)
-            return self.replace(document_id, document, commit=commit, _t=_t + 1)
         if commit:
             database = self.commit()
         return docid
@@ -665,114 +946,43 @@ class Database(object):
             document_id = prefixed(document_id, DOCUMENT_ID_TERM_PREFIX)
         return self.drop(document_id, commit=commit)
 
-    def drop(self, document_id, commit=False, _t=0):
+    @retry_xapian()
+    def drop(self, document_id, commit=False):
         database = self.database
-        try:
-            database.delete_document(document_id)
-        except (xapian.NetworkError, xapian.DatabaseError) as exc:
-            if _t > 3:
-                raise XapianError(exc)
-            elif _t > 1:
-                gevent.sleep(0.1)
-            self.reopen(_t > 1)
-            return self.drop(document_id, commit=commit, _t=_t + 1)
+        database.delete_document(document_id)
         if commit:
             database = self.commit()
 
-    def commit(self, _t=0):
-        database = self.database
-        try:
-            database.commit()
-        except (xapian.NetworkError, xapian.DatabaseError) as exc:
-            if _t > 3:
-                raise XapianError(exc)
-            elif _t > 1:
-                gevent.sleep(0.1)
-            self.reopen(_t > 1)
-            return self.commit(_t=_t + 1)
-
-    def get_uuid(self, _t=0):
-        database = self.database
-        try:
-            uuid = database.get_uuid()
-        except (xapian.NetworkError, xapian.DatabaseError) as exc:
-            if _t > 3:
-                raise XapianError(exc)
-            elif _t > 1:
-                gevent.sleep(0.1)
-            self.reopen(_t > 1)
-            return self.get_uuid(_t=_t + 1)
-        return uuid
-
-    def get_doccount(self, _t=0):
-        database = self.database
-        try:
-            doccount = database.get_doccount()
-        except (xapian.NetworkError, xapian.DatabaseError) as exc:
-            if _t > 3:
-                raise XapianError(exc)
-            elif _t > 1:
-                gevent.sleep(0.1)
-            self.reopen(_t > 1)
-            return self.get_doccount(_t=_t + 1)
-        return doccount
-
-    def get_document(self, docid, _t=0):
-        database = self.database
-        try:
-            document = database.get_document(docid)
-        except (xapian.NetworkError, xapian.DatabaseError) as exc:
-            if _t > 3:
-                raise XapianError(exc)
-            elif _t > 1:
-                gevent.sleep(0.1)
-            self.reopen(_t > 1)
-            return self.get_document(docid, _t=_t + 1)
-        return document
-
-    def get_value(self, document, slot, _t=0):
-        database = self.database
-        try:
-            value = document.get_value(slot)
-        except (xapian.NetworkError, xapian.DatabaseError) as exc:
-            if _t > 3:
-                raise XapianError(exc)
-            elif _t > 1:
-                gevent.sleep(0.1)
-            if self.reopen(_t > 1) != database:
-                document = self.get_document(document.get_docid())
-            return self.get_value(document, slot, _t=_t + 1)
-        return value
+    @retry_xapian()
+    def commit(self):
+        self.database.commit()
 
-    def get_data(self, document, _t=0):
-        database = self.database
+    @retry_xapian()
+    def get_uuid(self):
+        return self.database.get_uuid()
+
+    @retry_xapian()
+    def get_doccount(self):
+        return self.database.get_doccount()
+
+    @retry_xapian()
+    def get_document(self, docid):
+        return self.database.get_document(docid)
+
+    @retry_xapian(refetch=True)
+    def get_value(self, document, slot):
+        return document.get_value(slot)
+
+    @retry_xapian(refetch=True)
+    def get_data(self, document):
         try:
-            _data = document.get_data()
+            return document.get_data()
         except xapian.DocNotFoundError:
             return
-        except (xapian.NetworkError, xapian.DatabaseError) as exc:
-            if _t > 3:
-                raise XapianError(exc)
-            elif _t > 1:
-                gevent.sleep(0.1)
-            if self.reopen(_t > 1) != database:
-                document = self.get_document(document.get_docid())
-            return self.get_data(document, _t=_t + 1)
-        return _data
-
-    def get_termlist(self, document, _t=0):
-        database = self.database
-        try:
-            termlist = document.termlist()
-        except (xapian.NetworkError, xapian.DatabaseError) as exc:
-            if _t > 3:
-                raise XapianError(exc)
-            elif _t > 1:
-                gevent.sleep(0.1)
-            if self.reopen(_t > 1) != database:
-                document = self.get_document(document.get_docid())
-            return self.get_termlist(document, _t=_t + 1)
-        return termlist
+
+    @retry_xapian(refetch=True)
+    def get_termlist(self, document):
+        return document.termlist()
 
 
 def xapian_cleanup(databases_pool, timeout, data='.', log=logging):
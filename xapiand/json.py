@@ -99,12 +99,22 @@ def dump(obj, fp, **kwargs):
     return json.dump(obj, fp, cls=XapianJSONEncoder, **kwargs)
 
 
+_default_encoder = None
+
+
 def dumps(value, **kwargs):
+    global _default_encoder
     ensure_ascii = kwargs.pop('ensure_ascii', True)
-    kwargs['ensure_ascii'] = False
-    if 'encoding' not in kwargs:
-        kwargs['encoding'] = 'safe-utf-8'
-    dump = json.dumps(value, cls=XapianJSONEncoder, **kwargs)
+    if kwargs:
+        kwargs['ensure_ascii'] = False
+        if 'encoding' not in kwargs:
+            kwargs['encoding'] = 'safe-utf-8'
+        dump = json.dumps(value, cls=XapianJSONEncoder, **kwargs)
+    else:
+        # Hot path (one call per streamed search result), reuse the encoder:
+        if _default_encoder is None:
+            _default_encoder = XapianJSONEncoder(ensure_ascii=False, encoding='safe-utf-8')
+        dump = _default_encoder.encode(value)
     if ensure_ascii:
         dump = dump.encode('safe-utf-8')
     return dump
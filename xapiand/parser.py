@@ -57,6 +57,9 @@ def index_parser(document):
             "positions": False
         }
 
+    Terms and texts can also be given as arrays, in the same order as the
+    object fields above (e.g. ["<term_N_string>", term_N_weight, "term_N_prefix"]).
+
     """
     try:
         if not isinstance(document, dict):
@@ -100,16 +103,19 @@ def index_parser(document):
     if not isinstance(_document_terms, list):
         return ">> ERR: [400] 'terms' must be a list of objects"
     for texts in _document_terms:
-        try:
-            get = texts.get
-        except AttributeError:
-            return ">> ERR: [400] 'terms' must be a list of objects"
-        term = get('term')
+        if isinstance(texts, (tuple, list)):
+            term, weight, prefix, position = (list(texts) + [None] * 4)[:4]
+        else:
+            try:
+                get = texts.get
+            except AttributeError:
+                return ">> ERR: [400] 'terms' must be a list of objects"
+            term = get('term')
+            weight = get('weight')
+            prefix = get('prefix')
+            position = get('position')
         if not term:
             return ">> ERR: [400] 'term' is required"
-        weight = get('weight')
-        prefix = get('prefix')
-        position = get('position')
         document_terms.append((term, weight, prefix, position))
 
     document_texts = []
@@ -117,18 +123,21 @@ def index_parser(document):
     if not isinstance(_document_texts, list):
         return ">> ERR: [400] 'texts' must be a list of objects"
     for texts in _document_texts:
-        try:
-            get = texts.get
-        except AttributeError:
-            return ">> ERR: [400] 'texts' must be a list of objects"
-        text = get('text')
+        if isinstance(texts, (tuple, list)):
+            text, weight, prefix, language, spelling, positions = (list(texts) + [None] * 6)[:6]
+        else:
+            try:
+                get = texts.get
+            except AttributeError:
+                return ">> ERR: [400] 'texts' must be a list of objects"
+            text = get('text')
+            weight = get('weight')
+            prefix = get('prefix')
+            language = get('language')
+            spelling = get('spelling')
+            positions = get('positions')
         if not text:
             return ">> ERR: [400] 'text' is required"
-        weight = get('weight')
-        prefix = get('prefix')
-        language = get('language')
-        spelling = get('spelling')
-        positions = get('positions')
         if language == default_language:
             language = None
         if spelling == default_spelling:
@@ -8,7 +8,17 @@ import atexit
 import importlib
 import signal as _signal
 import numbers
-import itertools
+from collections import OrderedDict
+
+from .utils import lru_cache
+
+try:
+    string_types = basestring
+    xrange = xrange
+except NameError:  # pragma: no cover
+    # Py3
+    string_types = str
+    xrange = range
 
 try:
     from io import UnsupportedOperation
@@ -20,8 +30,7 @@ except ImportError:  # pragma: no cover
 
 def uniq(it):
     """Return all unique elements in ``it``, preserving order."""
-    seen = set()
-    return (seen.add(obj) or obj for obj in it if obj not in seen)
+    return list(OrderedDict.fromkeys(it))
 
 
 def get_errno(exc):
@@ -69,33 +78,106 @@ class LockFailed(Exception):
 EX_CANTCREAT = getattr(os, 'EX_CANTCREAT', 73)
 EX_FAILURE = 1
 
-PIDFILE_FLAGS = os.O_CREAT | os.O_EXCL | os.O_WRONLY
+O_CLOEXEC = getattr(os, 'O_CLOEXEC', 0)
+
+PIDFILE_FLAGS = os.O_CREAT | os.O_EXCL | os.O_WRONLY | O_CLOEXEC
+NETWORK_FILESYSTEMS = frozenset([
+    'nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'afs', 'ncpfs', '9p', 'fuse.sshfs',
+])
+
 PIDFILE_MODE = ((os.R_OK | os.W_OK) << 6) | ((os.R_OK) << 3) | ((os.R_OK))
 
 PIDLOCKED = """ERROR: Pidfile ({0}) already exists.
 Seems we're already running? (pid: {1})"""
 
 
-def get_fdmax(default=None):
-    """Return the maximum number of open file descriptors
-    on this system.
+_fdmax = None  # cached (fdmax,) once computed
 
-    :keyword default: Value returned if there's no file
-                      descriptor limit.
 
-    """
+def _get_fdmax():
     try:
         return os.sysconf('SC_OPEN_MAX')
     except Exception:
         pass
     if resource is None:  # Windows
-        return default
+        return None
     fdmax = resource.getrlimit(resource.RLIMIT_NOFILE)[1]
     if fdmax == resource.RLIM_INFINITY:
-        return default
+        return None
     return fdmax
 
 
+def get_fdmax(default=None):
+    """Return the maximum number of open file descriptors
+    on this system.
+
+    The limit is only looked up once; call :func:`invalidate_fdmax_cache`
+    after changing it (e.g. with :func:`resource.setrlimit`).
+
+    :keyword default: Value returned if there's no file
+                      descriptor limit.
+
+    """
+    global _fdmax
+    if _fdmax is None:
+        _fdmax = (_get_fdmax(),)
+    fdmax = _fdmax[0]
+    return default if fdmax is None else fdmax
+
+
+def invalidate_fdmax_cache():
+    """Forget the limit cached by :func:`get_fdmax`."""
+    global _fdmax
+    _fdmax = None
+
+
+def _fdatasync(fd):
+    """Flush the data of ``fd`` to disk (without metadata, if possible)."""
+    sync = getattr(os, 'fdatasync', None) or getattr(os, 'fsync', None)
+    if sync is not None:  # pragma: no branch
+        sync(fd)
+
+
+def _fsync_dir(path):
+    """Flush directory entries of ``path`` to disk, where supported."""
+    try:
+        dir_fd = os.open(path or '.', os.O_RDONLY | O_CLOEXEC)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except (OSError, AttributeError):
+        pass
+    finally:
+        os.close(dir_fd)
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+
+
+def _is_network_fs(path):
+    """Return true unless ``path`` is known to be in a local filesystem."""
+    try:
+        with open('/proc/mounts') as fh:
+            mounts = [line.split()[1:3] for line in fh]
+    except (IOError, OSError):
+        return True
+    path = os.path.realpath(path)
+    fstype, longest = None, -1
+    for mountpoint, mount_fstype in mounts:
+        mountpoint = mountpoint.replace('\\040', ' ')
+        if len(mountpoint) > longest and (
+                path == mountpoint or
+                path.startswith(mountpoint.rstrip('/') + '/')):
+            fstype, longest = mount_fstype, len(mountpoint)
+    return fstype is None or fstype in NETWORK_FILESYSTEMS
+
+
 class Pidfile(object):
     """Pidfile
 
@@ -145,19 +227,23 @@ class Pidfile(object):
                 except ValueError:
                     raise ValueError(
                         'pidfile {0.path} contents invalid.'.format(self))
-        except errno.ENOENT:
-            pass
+        except (IOError, OSError) as exc:
+            if exc.errno != errno.ENOENT:
+                raise
 
     def remove(self):
         """Remove the lock."""
         try:
             os.unlink(self.path)
-        except (errno.ENOENT, errno.EACCES):
-            pass
+        except OSError as exc:
+            if exc.errno not in (errno.ENOENT, errno.EACCES):
+                raise
 
     def remove_if_stale(self):
         """Remove the lock if the process is not running.
         (does not respond to signals)."""
+        if not self.is_locked():
+            return True
         try:
             pid = self.read_pid()
         except ValueError:
@@ -173,31 +259,57 @@ class Pidfile(object):
             return True
         return False
 
-    def write_pid(self):
+    def write_pid(self, verify=None):
+        """Write the current pid, failing if the pidfile already exists.
+
+        :keyword verify: Read the pidfile back to make sure it was written;
+                         by default only done on network filesystems (where
+                         ``O_EXCL`` can't be trusted).
+
+        """
         pid = os.getpid()
         content = '{0}\n'.format(pid)
 
-        pidfile_fd = os.open(self.path, PIDFILE_FLAGS, PIDFILE_MODE)
+        # Write a temporary file and hard link it into place, so the pidfile
+        # never shows up partially written (unlike rename, link fails if the
+        # pidfile already exists).
+        tmp_path = '{0}.{1}.tmp'.format(self.path, pid)
+        _unlink(tmp_path)
+        self._write(tmp_path, content)
+        try:
+            os.link(tmp_path, self.path)
+        except OSError as exc:
+            if exc.errno == errno.EEXIST:
+                raise
+            # No hard links in this filesystem, create the pidfile directly:
+            self._write(self.path, content)
+        finally:
+            _unlink(tmp_path)
+        _fsync_dir(os.path.dirname(self.path))
+
+        if verify is None:
+            verify = _is_network_fs(os.path.dirname(self.path))
+        if verify:
+            rfh = os.fdopen(os.open(self.path, os.O_RDONLY | O_CLOEXEC))
+            try:
+                if rfh.read() != content:
+                    raise LockFailed(
+                        "Inconsistency: Pidfile content doesn't match at re-read")
+            finally:
+                rfh.close()
+
+    def _write(self, path, content):
+        pidfile_fd = os.open(path, PIDFILE_FLAGS, PIDFILE_MODE)
         pidfile = os.fdopen(pidfile_fd, 'w')
         try:
             pidfile.write(content)
-            # flush and sync so that the re-read below works.
+            # flush and sync, so the content is on disk before write_pid()
+            # links it into place (and possibly reads it back).
             pidfile.flush()
-            try:
-                os.fsync(pidfile_fd)
-            except AttributeError:  # pragma: no cover
-                pass
+            _fdatasync(pidfile_fd)
         finally:
             pidfile.close()
 
-        rfh = open(self.path)
-        try:
-            if rfh.read() != content:
-                raise LockFailed(
-                    "Inconsistency: Pidfile content doesn't match at re-read")
-        finally:
-            rfh.close()
-
 
 def create_pidlock(pidfile):
     """Create and verify pidfile.
@@ -236,44 +348,135 @@ def _create_pidlock(pidfile):
 resource = try_import('resource')
 pwd = try_import('pwd')
 grp = try_import('grp')
+fcntl = try_import('fcntl')
+ctypes = try_import('ctypes')
+
+CLOSE_RANGE_MAX = 0xffffffff  # ~0U, close_range(2) clamps it to the highest open fd
+CLOSE_RANGE_CLOEXEC = getattr(os, 'CLOSE_RANGE_CLOEXEC', 4)  # Linux 5.11+, FreeBSD 13.1+
+
+if hasattr(os, 'close_range'):
+    close_range = os.close_range
+else:
+    close_range = None
+    if ctypes is not None:
+        try:
+            _close_range = ctypes.CDLL(None, use_errno=True).close_range
+        except (OSError, TypeError, AttributeError):
+            pass
+        else:
+            _close_range.argtypes = (ctypes.c_uint, ctypes.c_uint, ctypes.c_int)
+
+            def close_range(low, high, flags=0):
+                """Close file descriptors ``low`` to ``high`` (inclusive)
+                using the close_range(2) syscall."""
+                if _close_range(low, high, flags) != 0:
+                    err = ctypes.get_errno()
+                    raise OSError(err, os.strerror(err))
+
+# Whether processes can be looked up in /proc/<pid>:
+PROC_PIDS = sys.platform.startswith('linux') and os.path.isdir('/proc/self')
 
 DAEMON_UMASK = 0
 DAEMON_WORKDIR = '/'
 
+
+def _list_open_fds():
+    """Return the file descriptors currently open by this process, or
+    :const:`None` if they can't be listed."""
+    try:
+        return [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except (OSError, ValueError):
+        pass
+    try:
+        # /dev/fd only lists all descriptors on macOS or when fdescfs is
+        # mounted on it (otherwise it just has 0, 1 and 2).
+        if sys.platform == 'darwin' or os.stat('/dev/fd').st_dev != os.stat('/dev').st_dev:
+            return [int(fd) for fd in os.listdir('/dev/fd')]
+    except (OSError, ValueError):
+        pass
+
+
+def _set_cloexec(fds, keep):
+    """Mark ``fds`` (or every possible fd, if :const:`None`) but
+    the ones in ``keep`` as close-on-exec."""
+    if fcntl is None:  # Windows
+        return
+    if fds is None:
+        fds = xrange(get_fdmax(default=2048))
+    for fd in fds:
+        if fd not in keep:
+            try:
+                flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+                fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+            except (IOError, OSError):
+                pass
+
+
 if hasattr(os, 'closerange'):
 
-    def close_open_fds(keep=None):
+    def close_open_fds(keep=None, cloexec_only=False):
         # must make sure this is 0-inclusive (Issue #1882)
-        keep = list(uniq(sorted(
+        keep = uniq(sorted(
             f for f in map(maybe_fileno, keep or []) if f is not None
-        )))
-        maxfd = get_fdmax(default=2048)
-        kL, kH = iter([-1] + keep), iter(keep + [maxfd])
-        for low, high in itertools.izip_longest(kL, kH):
-            if low + 1 != high:
-                os.closerange(low + 1, high)
+        ))
+        if close_range is not None:
+            flags = CLOSE_RANGE_CLOEXEC if cloexec_only else 0
+            try:
+                bounds = [-1] + keep + [CLOSE_RANGE_MAX + 1]
+                for i in range(len(bounds) - 1):
+                    low, high = bounds[i] + 1, bounds[i + 1]
+                    if low < high:
+                        close_range(low, high - 1, flags)
+                return
+            except OSError:
+                pass  # kernel without close_range(2) (or the flag)
+        fds = _list_open_fds()
+        if cloexec_only:
+            _set_cloexec(fds, keep)
+            return
+        if fds is not None:
+            for fd in fds:
+                if fd not in keep:
+                    try:
+                        os.close(fd)
+                    except OSError:
+                        pass  # e.g. the fd used to list the directory
+            return
+        bounds = [-1] + keep + [get_fdmax(default=2048)]
+        for i in range(len(bounds) - 1):
+            low, high = bounds[i] + 1, bounds[i + 1]
+            if low < high:
+                os.closerange(low, high)
 
 else:
 
-    def close_open_fds(keep=None):  # noqa
-        keep = [maybe_fileno(f)
-                for f in (keep or []) if maybe_fileno(f) is not None]
-        for fd in reversed(range(get_fdmax(default=2048))):
+    def close_open_fds(keep=None, cloexec_only=False):  # noqa
+        keep = frozenset(maybe_fileno(f)
+                         for f in (keep or []) if maybe_fileno(f) is not None)
+        fds = _list_open_fds()
+        if cloexec_only:
+            _set_cloexec(fds, keep)
+            return
+        if fds is None:
+            fds = xrange(get_fdmax(default=2048) - 1, -1, -1)
+        for fd in fds:
             if fd not in keep:
                 try:
                     os.close(fd)
-                except errno.EBADF:
-                    pass
+                except OSError as exc:
+                    if exc.errno != errno.EBADF:
+                        raise
 
 
 class DaemonContext(object):
     _is_open = False
 
     def __init__(self, pidfile=None, workdir=None, umask=None,
-                 fake=False, after_chdir=None, **kwargs):
+                 fake=False, after_chdir=None, single_fork=False, **kwargs):
         self.workdir = workdir or DAEMON_WORKDIR
         self.umask = DAEMON_UMASK if umask is None else umask
         self.fake = fake
+        self.single_fork = single_fork
         self.after_chdir = after_chdir
         self.stdfds = (sys.stdin, sys.stdout, sys.stderr)
 
@@ -308,7 +511,10 @@ class DaemonContext(object):
     def _detach(self):
         if os.fork() == 0:      # first child
             os.setsid()         # create new session
-            if os.fork() > 0:   # second child
+            # The second fork makes sure the daemon isn't a session leader,
+            # so it can never acquire a controlling terminal again (with
+            # single_fork that's up to the daemon, e.g. supervised services).
+            if not self.single_fork and os.fork() > 0:   # second child
                 os._exit(0)
         else:
             os._exit(0)
@@ -316,7 +522,7 @@ class DaemonContext(object):
 
 
 def detached(logfile=None, pidfile=None, uid=None, gid=None, umask=0,
-             workdir=None, fake=False, **opts):
+             workdir=None, fake=False, single_fork=False, **opts):
     """Detach the current process in the background (daemonize).
 
     :keyword logfile: Optional log file.  The ability to write to this file
@@ -331,6 +537,9 @@ def detached(logfile=None, pidfile=None, uid=None, gid=None, umask=0,
     :keyword umask: Optional umask that will be effective in the child process.
     :keyword workdir: Optional new working directory.
     :keyword fake: Don't actually detach, intented for debugging purposes.
+    :keyword single_fork: Fork only once; the daemon stays a session
+      leader (which could get a controlling terminal by opening a tty),
+      but detaching a process with a large heap gets cheaper.
     :keyword \*\*opts: Ignored.
 
     **Example**:
@@ -368,16 +577,20 @@ def detached(logfile=None, pidfile=None, uid=None, gid=None, umask=0,
 
     return DaemonContext(
         umask=umask, workdir=workdir, fake=fake, after_chdir=after_chdir_do,
+        single_fork=single_fork,
     )
 
 
+@lru_cache(maxsize=256)
 def parse_uid(uid):
     """Parse user id.
 
     uid can be an integer (uid) or a string (user name), if a user name
-    the uid is taken from the system user registry.
+    the uid is taken from the system user registry (and remembered).
 
     """
+    if not isinstance(uid, string_types) or uid.isdigit():
+        return int(uid)
     try:
         return int(uid)
     except ValueError:
@@ -387,13 +600,16 @@ def parse_uid(uid):
             raise KeyError('User does not exist: {0}'.format(uid))
 
 
+@lru_cache(maxsize=256)
 def parse_gid(gid):
     """Parse group id.
 
     gid can be an integer (gid) or a string (group name), if a group name
-    the gid is taken from the system group registry.
+    the gid is taken from the system group registry (and remembered).
 
     """
+    if not isinstance(gid, string_types) or gid.isdigit():
+        return int(gid)
     try:
         return int(gid)
     except ValueError:
@@ -558,6 +774,9 @@ class Signals(object):
     ignored = _signal.SIG_IGN
     default = _signal.SIG_DFL
 
+    #: Signal numbers already looked up by :meth:`signum`, by name.
+    _signums = {}
+
     if hasattr(_signal, 'setitimer'):
 
         def arm_alarm(self, seconds):
@@ -588,12 +807,19 @@ class Signals(object):
         """Get signal number from signal name."""
         if isinstance(signal_name, numbers.Integral):
             return signal_name
-        if not isinstance(signal_name, basestring) \
+        try:
+            return self._signums[signal_name]
+        except (KeyError, TypeError):
+            pass
+        if not isinstance(signal_name, string_types) \
                 or not signal_name.isupper():
             raise TypeError('signal name must be uppercase string.')
         if not signal_name.startswith('SIG'):
-            signal_name = 'SIG' + signal_name
-        return getattr(_signal, signal_name)
+            signum = getattr(_signal, 'SIG' + signal_name)
+        else:
+            signum = getattr(_signal, signal_name)
+        self._signums[signal_name] = signum
+        return signum
 
     def reset(self, *signal_names):
         """Reset signals to the default signal handler.
@@ -629,9 +855,31 @@ class Signals(object):
             pass
 
     def update(self, _d_=None, **sigmap):
-        """Set signal handlers from a mapping."""
+        """Set signal handlers from a mapping.
+
+        Where supported, the signals are blocked while their handlers are
+        being replaced, so none of them is delivered halfway through.
+
+        """
+        handlers = []
         for signal_name, handler in dict(_d_ or {}, **sigmap).items():
-            self[signal_name] = handler
+            signum = self.supported(signal_name)
+            if signum:
+                handlers.append((signum, handler))
+        if not handlers:
+            return
+        sigmask = getattr(_signal, 'pthread_sigmask', None)  # Py3.3+, UNIX
+        if sigmask is not None:
+            blocked = sigmask(_signal.SIG_BLOCK, [num for num, _ in handlers])
+        try:
+            for signum, handler in handlers:
+                try:
+                    _signal.signal(signum, handler)
+                except ValueError:
+                    pass
+        finally:
+            if sigmask is not None:
+                sigmask(_signal.SIG_SETMASK, blocked)
 
 signals = Signals()
 
@@ -648,6 +896,18 @@ def pid_exists(pid):
         # On certain systems 0 is a valid PID but we have no way
         # to know that in a portable fashion.
         raise ValueError('invalid PID 0')
+    if PROC_PIDS:
+        # Cheaper than signalling, but thread ids have a /proc entry too (so
+        # it must be its own thread group) and a missing entry isn't
+        # conclusive (/proc may be mounted with hidepid), so let kill()
+        # confirm that.
+        try:
+            with open('/proc/{0}/status'.format(pid)) as fh:
+                for line in fh:
+                    if line.startswith('Tgid:'):
+                        return int(line.split()[1]) == pid
+        except (IOError, OSError, ValueError):
+            pass
     try:
         os.kill(pid, 0)
     except OSError as err:
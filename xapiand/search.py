@@ -1,7 +1,10 @@
 from __future__ import unicode_literals, absolute_import
 
+import re
 import base64
 import logging
+import threading
+from collections import OrderedDict
 
 import xapian
 
@@ -12,6 +15,28 @@ from .exceptions import XapianError
 
 MAX_DOCS = 10000
 
+QUERY_CACHE_SIZE = 1024
+
+# Serialised parsed queries, least recently used first (commands run in
+# threads, so every access goes through the lock; xapian.Query objects can't
+# be shared between threads, so only their serialisation is kept):
+_queries = OrderedDict()
+_queries_lock = threading.Lock()
+
+
+def _alive():
+    pass
+
+
+def _aslist(value):
+    return value if isinstance(value, (tuple, list)) else [value]
+
+
+def _freeze(value):
+    if isinstance(value, (tuple, list)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
 
 class Search(object):
     def __init__(self, database, search,
@@ -28,9 +53,11 @@ class Search(object):
         self.data = data
         self.log = log
         self.dead = dead
+        self.check_alive = getattr(dead, 'check', _alive)
 
         self.spies = {}
         self.warnings = []
+        self.enquire_config = None
         self.produced = 0
 
         self.size = None
@@ -42,9 +69,52 @@ class Search(object):
         self.setup()
 
     def setup(self):
-        queryparser = xapian.QueryParser()
+        search = self.search
+        key = (
+            self.database.database._endpoints,
+            _freeze(search.get('search')),
+            _freeze(search.get('partials')),
+            _freeze(search.get('terms')),
+            _freeze(search.get('ranges')),
+        )
+        try:
+            with _queries_lock:
+                serialised = _queries.pop(key)
+                _queries[key] = serialised
+            query = xapian.Query.unserialise(serialised)
+        except KeyError:
+            query = self.parse_query()
+            serialised = query.serialise()
+            with _queries_lock:
+                _queries[key] = serialised
+                if len(_queries) > QUERY_CACHE_SIZE:
+                    _queries.popitem(last=False)
+        except TypeError:  # unhashable search
+            query = self.parse_query()
+
+        self.query = query
+        self.sort_by = self.search.get('sort_by')
+        self.distinct = self.search.get('distinct')
+        self.sort_by_reversed = self.search.get('sort_by_reversed')
+
+    def parse_query(self):
+        search_get = self.search.get
+        Query = xapian.Query
+        OP_AND = Query.OP_AND
+        OP_AND_MAYBE = Query.OP_AND_MAYBE
+        QueryParser = xapian.QueryParser
+
+        queryparser = QueryParser()
         queryparser.set_database(self.database.database)
 
+        def parse(string, flags):
+            try:
+                return queryparser.parse_query(string, flags)
+            except (xapian.NetworkError, xapian.DatabaseError):
+                self.database.reopen()
+                queryparser.set_database(self.database.database)
+                return queryparser.parse_query(string, flags)
+
         query = None
 
         prefixes = set()
@@ -60,17 +130,16 @@ class Search(object):
                     prefixes.add(term_field)
 
         # Build final query:
-        search = self.search.get('search')
+        search = search_get('search')
         if search:
-            if not isinstance(search, (tuple, list)):
-                search = [search]
-            search = " AND ".join("(%s)" % s for s in search if s)
+            search = " AND ".join("(%s)" % s for s in _aslist(search) if s)
         if search and search != '(*)':
             search = normalize(search).encode('utf-8')
 
-            ranges = self.search.get('ranges')
+            ranges = search_get('ranges')
             if ranges:
                 _ranges = set()
+                substitutions = OrderedDict()
                 for field, begin, end in ranges:
                     field = field.encode('utf-8')
                     if field not in _ranges:
@@ -84,98 +153,117 @@ class Search(object):
                         end = b''
                     rng1 = b'(%s:%s..%s)' % (field, begin, end)
                     rng2 = b'(%s:%s..%s)' % (field, serialise_value(begin)[0], serialise_value(end)[0])
-                    if rng1 == rng2:
-                        _search = search
-                        if rng1 in search:
-                            search = None
-                    else:
-                        _search = search.replace(rng1, rng2)
-                    if search != _search:
-                        search = _search
-                    else:
-                        search += b' AND %s' % rng2
+                    substitutions.setdefault(rng1, rng2)
+
+                # Ranges already in the search get their serialised values
+                # (in a single pass), the rest are added to it:
+                if substitutions:
+                    found = set()
+
+                    def substitute(match):
+                        rng = match.group(0)
+                        found.add(rng)
+                        return substitutions[rng]
+                    search = re.sub(b'|'.join(re.escape(rng) for rng in substitutions), substitute, search)
+                    missing = [serialised for rng, serialised in substitutions.items() if rng not in found]
+                    if missing:
+                        search = b' AND '.join([search] + missing)
 
             search = expand_terms(search)
             add_prefixes(search)
-            flags = xapian.QueryParser.FLAG_DEFAULT | xapian.QueryParser.FLAG_WILDCARD | xapian.QueryParser.FLAG_PURE_NOT
-            try:
-                query = queryparser.parse_query(search, flags)
-            except (xapian.NetworkError, xapian.DatabaseError):
-                self.database.reopen()
-                queryparser.set_database(self.database.database)
-                query = queryparser.parse_query(search, flags)
+            query = parse(search, QueryParser.FLAG_DEFAULT | QueryParser.FLAG_WILDCARD | QueryParser.FLAG_PURE_NOT)
 
-        partials = self.search.get('partials')
+        partials = search_get('partials')
         if partials:
-            if not isinstance(partials, (tuple, list)):
-                partials = [partials]
             # Partials (for autocomplete) using FLAG_PARTIAL and OP_AND_MAYBE
             partials_query = None
-            for partial in partials:
-                self.dead or 'alive'  # Raises DeadException when needed
+            for partial in _aslist(partials):
+                self.check_alive()  # Raises DeadException when needed
                 partial = normalize(partial)
                 partial = expand_terms(partial)
                 add_prefixes(partial)
-                flags = xapian.QueryParser.FLAG_PARTIAL
-                try:
-                    _partials_query = queryparser.parse_query(partial, flags)
-                except (xapian.NetworkError, xapian.DatabaseError):
-                    self.database.reopen()
-                    queryparser.set_database(self.database.database)
-                    _partials_query = queryparser.parse_query(partial, flags)
+                _partials_query = parse(partial, QueryParser.FLAG_PARTIAL)
                 if partials_query:
-                    partials_query = xapian.Query(
-                        xapian.Query.OP_AND_MAYBE,
-                        partials_query,
-                        _partials_query,
-                    )
+                    partials_query = Query(OP_AND_MAYBE, partials_query, _partials_query)
                 else:
                     partials_query = _partials_query
             if query:
-                query = xapian.Query(
-                    xapian.Query.OP_AND,
-                    query,
-                    partials_query,
-                )
+                query = Query(OP_AND, query, partials_query)
             else:
                 query = partials_query
 
-        terms = self.search.get('terms')
+        terms = search_get('terms')
         if terms:
-            if not isinstance(terms, (tuple, list)):
-                terms = [terms]
-            for term in terms:
-                term = normalize(term)
-                term = expand_terms(term)
-                add_prefixes(term)
-                flags = xapian.QueryParser.FLAG_BOOLEAN | xapian.QueryParser.FLAG_PURE_NOT
-                try:
-                    terms_query = queryparser.parse_query(term, flags)
-                except (xapian.NetworkError, xapian.DatabaseError):
-                    self.database.reopen()
-                    queryparser.set_database(self.database.database)
-                    terms_query = queryparser.parse_query(term, flags)
-                if query:
-                    query = xapian.Query(
-                        xapian.Query.OP_AND,
-                        query,
-                        terms_query,
-                    )
-                else:
-                    query = terms_query
+            # Terms are all ANDed together, so they are parsed at once:
+            terms = " AND ".join("(%s)" % expand_terms(normalize(t)) for t in _aslist(terms) if t)
+            add_prefixes(terms)
+            terms_query = parse(terms, QueryParser.FLAG_BOOLEAN | QueryParser.FLAG_PURE_NOT)
+            if query:
+                query = Query(OP_AND, query, terms_query)
+            else:
+                query = terms_query
 
         if not query:
             if search == '(*)':
-                query = xapian.Query('')
+                query = Query('')
             else:
-                query = xapian.Query()
+                query = Query()
+
+        return query
+
+    def get_enquire_config(self):
+        """
+        Resolves facets, sort fields and the collapse key to value slots.
+
+        This only depends on the search (not on the database), so it's done
+        once even if the enquire has to be rebuilt after a reopen.
+
+        """
+        if self.enquire_config is None:
+            facets = []
+            sorter = None
+            collapse_key = None
+            warnings = []
+
+            if self.facets:
+                for name in self.facets:
+                    self.check_alive()  # Raises DeadException when needed
+                    name = name.strip().lower()
+                    slot = get_slot(name)
+                    if slot:
+                        facets.append((name, slot))
+                    else:
+                        warnings.append("Ignored document value name (%r)" % name)
+
+            if self.sort_by:
+                sorter = xapian.MultiValueKeyMaker()
+                for name in self.sort_by:
+                    self.check_alive()  # Raises DeadException when needed
+                    if name.startswith('-'):
+                        reverse = True
+                        name = name[1:]  # Strip the '-'
+                    else:
+                        reverse = False
+                    name = name.strip().lower()
+                    slot = get_slot(name)
+                    if slot:
+                        sorter.add_value(slot, reverse)
+                    else:
+                        warnings.append("Ignored document value name (%r)" % name)
 
-        self.query = query
-        self.sort_by = self.search.get('sort_by')
-        self.distinct = self.search.get('distinct')
-        self.sort_by_reversed = self.search.get('sort_by_reversed')
+            if self.distinct:
+                if self.distinct is True:
+                    field = 'ID'
+                else:
+                    field = self.distinct
+                collapse_key = get_slot(field)
+
+            self.enquire_config = (facets, sorter, collapse_key, warnings)
+        return self.enquire_config
 
     def get_enquire(self):
+        facets, sorter, collapse_key, warnings = self.get_enquire_config()
+
         enquire = xapian.Enquire(self.database.database)
         # enquire.set_weighting_scheme(xapian.BoolWeight())
         # enquire.set_docid_order(xapian.Enquire.DONT_CARE)
@@ -183,49 +271,18 @@ class Search(object):
         #     enquire.set_weighting_scheme(xapian.BM25Weight(*self.weighting_scheme))
         enquire.set_query(self.query)
 
+        # Spies accumulate the matches, these are always new:
         spies = {}
-        sort_by = []
-        warnings = []
-
-        if self.facets:
-            for name in self.facets:
-                self.dead or 'alive'  # Raises DeadException when needed
-                name = name.strip().lower()
-                slot = get_slot(name)
-                if slot:
-                    spy = xapian.ValueCountMatchSpy(slot)
-                    enquire.add_matchspy(spy)
-                    spies[name] = spy
-                else:
-                    warnings.append("Ignored document value name (%r)" % name)
-
-        if self.sort_by:
-            for sort_field in self.sort_by:
-                self.dead or 'alive'  # Raises DeadException when needed
-                if sort_field.startswith('-'):
-                    reverse = True
-                    sort_field = sort_field[1:]  # Strip the '-'
-                else:
-                    reverse = False
-                sort_by.append((sort_field, reverse))
-
-            sorter = xapian.MultiValueKeyMaker()
-            for name, reverse in sort_by:
-                self.dead or 'alive'  # Raises DeadException when needed
-                name = name.strip().lower()
-                slot = get_slot(name)
-                if slot:
-                    sorter.add_value(slot, reverse)
-                else:
-                    warnings.append("Ignored document value name (%r)" % name)
+        for name, slot in facets:
+            spy = xapian.ValueCountMatchSpy(slot)
+            enquire.add_matchspy(spy)
+            spies[name] = spy
+
+        if sorter is not None:
             enquire.set_sort_by_key_then_relevance(sorter, self.sort_by_reversed)
 
         if self.distinct:
-            if self.distinct is True:
-                field = 'ID'
-            else:
-                field = self.distinct
-            enquire.set_collapse_key(get_slot(field))
+            enquire.set_collapse_key(collapse_key)
         self.spies = spies
         self.warnings = warnings
 
@@ -263,22 +320,39 @@ class Search(object):
 
         if self.spies:
             for name, spy in self.spies.items():
-                self.dead or 'alive'  # Raises DeadException when needed
+                self.check_alive()  # Raises DeadException when needed
                 for facet in spy.values():
-                    self.dead or 'alive'  # Raises DeadException when needed
                     yield {
                         'facet': name,
                         'term': facet.term.decode('utf-8'),
                         'termfreq': facet.termfreq,
                     }
 
+        # Bind everything used per match, this loop runs for the whole mset:
+        id_slot = get_slot('ID')
+        check_alive = self.check_alive
+        database = self.database
+        get_document = database.get_document
+        get_value = database.get_value
+        get_data = self.get_data
+        get_terms = self.get_terms
+        if maxitems:
+            # Have all the documents in the mset fetched at once (it's a
+            # single round trip for remote databases):
+            try:
+                matches.fetch()
+            except (xapian.NetworkError, xapian.DatabaseError):
+                pass
         produced = 0
         for match in matches:
             docid = match.docid
-            document = self.database.get_document(docid)
+            try:
+                document = match.document
+            except (xapian.NetworkError, xapian.DatabaseError):
+                document = get_document(docid)
 
-            self.dead or 'alive'  # Raises DeadException when needed
-            id = self.database.get_value(document, get_slot('ID'))
+            check_alive()  # Raises DeadException when needed
+            id = get_value(document, id_slot)
 
             produced += 1
             result = {
@@ -288,26 +362,19 @@ class Search(object):
                 'weight': match.weight,
                 'percent': match.percent,
             }
-            if self.get_data:
-                data = self.database.get_data(document)
+            if get_data:
+                data = database.get_data(document)
                 if data is None:
                     continue
                 try:
                     data = json.loads(data)
                 except Exception:
                     data = base64.b64encode(data)
-                result.update({
-                    'data': data,
-                })
-            if self.get_terms:
-                terms = []
-                termlist = self.database.get_termlist(document)
-                for t in termlist:
-                    self.dead or 'alive'  # Raises DeadException when needed
-                    terms.append(t.term.decode('utf-8'))
-                result.update({
-                    'terms': terms,
-                })
+                result['data'] = data
+            if get_terms:
+                check_alive()  # Raises DeadException when needed
+                termlist = database.get_termlist(document)
+                result['terms'] = [t.term.decode('utf-8') for t in termlist]
             yield result
         self.produced = produced
 
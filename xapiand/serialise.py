@@ -29,7 +29,13 @@ def normalize(text):
     Utility method that converts strings to strings without accents and stuff.
 
     """
-    return ''.join(c for c in unicodedata.normalize('NFKD', unicode(text)) if not unicodedata.combining(c))
+    text = unicode(text)
+    try:
+        text.encode('ascii')
+        return text  # plain ASCII has no accents to strip
+    except UnicodeEncodeError:
+        pass
+    return ''.join(c for c in unicodedata.normalize('NFKD', text) if not unicodedata.combining(c))
 
 
 def serialise_value(value):
@@ -23,16 +23,47 @@ class DeadException(Exception):
         self.command = command
 
 
+class CommandsStats(object):
+    """
+    Executed commands stats, kept per thread so commands running in the
+    commands pool don't all write to the same counters. Reports add up the
+    counters of all the threads.
+
+    """
+    local = threading.local()
+    all_stats = weakref.WeakSet()  # entries go away with their threads
+    all_stats_lock = threading.Lock()
+
+    def __init__(self):
+        self.duration = 0
+        self.start = 0
+        self.count = 0
+
+    @classmethod
+    def current(cls):
+        try:
+            return cls.local.stats
+        except AttributeError:
+            stats = cls.local.stats = cls()
+            with cls.all_stats_lock:
+                cls.all_stats.add(stats)
+            return stats
+
+    @classmethod
+    def cps(cls):
+        with cls.all_stats_lock:
+            all_stats = list(cls.all_stats)
+        count = sum(stats.count for stats in all_stats)
+        duration = sum(stats.duration for stats in all_stats)
+        return count / duration if duration else 0.0
+
+
 class AliveCommand(object):
     """
     Raises DeadException if the object's cmd_id id is not the same
     as it was when the object was created.
 
     """
-    cmds_duration = 0
-    cmds_start = 0
-    cmds_count = 0
-
     def __init__(self, parent, cmd, origin):
         parent.cmd_id = getattr(parent, 'cmd_id', 0) + 1
         self.parent = parent
@@ -42,31 +73,40 @@ class AliveCommand(object):
         self.log = parent.log
         self.start = time.time()
 
+    def check(self):
+        if self.cmd_id != self.parent.cmd_id:
+            raise DeadException(self)
+
     def __nonzero__(self):
-        if self.cmd_id == self.parent.cmd_id:
-            return False
-        raise DeadException(self)
+        self.check()
+        return False
+    __bool__ = __nonzero__
 
     def executed(self, results, message="Executed command %d", logger=None):
-        if logger is None:
-            logger = self.log.debug
         now = time.time()
         cmd_duration = now - self.start
-        AliveCommand.cmds_duration += cmd_duration
-        AliveCommand.cmds_count += 1
-        logger(
-            "%s %s%s by %s ~%s (%0.3f cps)",
-            message % self.cmd_id,
-            self.cmd,
-            " -> %s" % results if results is not None else "",
-            self.origin,
-            format_time(cmd_duration),
-            AliveCommand.cmds_count / AliveCommand.cmds_duration,
-        )
-        if now - AliveCommand.cmds_start > 2 or AliveCommand.cmds_count >= 10000:
-            AliveCommand.cmds_start = now
-            AliveCommand.cmds_duration = 0
-            AliveCommand.cmds_count = 0
+        stats = CommandsStats.current()
+        stats.duration += cmd_duration
+        stats.count += 1
+        if logger is None:
+            # Skip building the debug message when nobody is going to see it:
+            log = self.log
+            if getattr(log, 'isEnabledFor', logging.root.isEnabledFor)(logging.DEBUG):
+                logger = log.debug
+        if logger is not None:
+            logger(
+                "%s %s%s by %s ~%s (%0.3f cps)",
+                message % self.cmd_id,
+                self.cmd,
+                " -> %s" % results if results is not None else "",
+                self.origin,
+                format_time(cmd_duration),
+                CommandsStats.cps(),
+            )
+        if now - stats.start > 2 or stats.count >= 10000:
+            stats.start = now
+            stats.duration = 0
+            stats.count = 0
 
     def cancelled(self):
         self.executed(None, message="Command %d cancelled", logger=self.log.warning)
@@ -179,9 +219,10 @@ class ClientReceiver(object):
         pass
 
     def sendLine(self, line):
-        line += self.delimiter
-        if line[0] not in ("#", " "):
-            line = "%s. %s" % (self.cmd_id, line)
+        if line[:1] in ("#", " "):
+            line += self.delimiter
+        else:
+            line = "%s. %s%s" % (self.cmd_id, line, self.delimiter)
         sendall(self.client_socket, line, encoding=self.encoding, encoding_errors=self.encoding_errors)
 
     def lineReceived(self, line):
@@ -245,8 +286,26 @@ class CommandReceiver(ClientReceiver):
 
     def __init__(self, *args, **kwargs):
         self._weak = False
+        self.commands = self.get_commands()
         super(CommandReceiver, self).__init__(*args, **kwargs)
 
+    @classmethod
+    def get_commands(cls):
+        """
+        Maps command names to their (unbound) functions, built once per class.
+
+        """
+        try:
+            return cls.__dict__['_commands']
+        except KeyError:
+            commands = {}
+            for name in dir(cls):
+                func = getattr(cls, name, None)
+                if getattr(func, 'command', None):
+                    commands[name] = getattr(func, '__func__', func)
+            cls._commands = commands
+            return commands
+
     def connectionMade(self, client):
         self.log.info("New connection from %s: %s:%d (%d open connections)" % (client.client_id, self.address[0], self.address[1], len(self.server.clients)))
         if self.welcome:
@@ -263,10 +322,8 @@ class CommandReceiver(ClientReceiver):
         if not cmd:
             return
         try:
-            func = getattr(self, cmd)
-            if not func.command:
-                raise AttributeError
-        except AttributeError:
+            func = self.commands[cmd].__get__(self, self.__class__)
+        except KeyError:
             self.sendLine(">> ERR: [404] Unknown command: %s" % cmd.upper())
         else:
             command = AliveCommand(self, cmd=cmd.upper(), origin="%s:%d" % (self.address[0], self.address[1]))
@@ -328,6 +328,39 @@ class XapiandReceiver(CommandReceiver):
         else:
             self.sendLine(result)
 
+    def _index_many(self, line, commit):
+        try:
+            documents = json.loads(line)
+            if not isinstance(documents, list):
+                raise ValueError("Documents must be a list")
+        except Exception as e:
+            self.sendLine(">> ERR: [400] %s" % e)
+            return
+        # Documents are all checked before any gets queued:
+        queued = {}
+        for document in documents:
+            result = index_parser(document)
+            if not isinstance(result, tuple):
+                self.sendLine(result)
+                return
+            endpoints, document = result
+            if not endpoints:
+                endpoints = self.active_endpoints
+            self._reopen(endpoints)
+            if not endpoints:
+                self.sendLine(">> ERR: [405] %s" % "You must connect to a database first")
+                return
+            for db in endpoints:
+                db = build_url(*parse_url(db.strip()))
+                queued.setdefault(db, []).append(document)
+        for db, documents in queued.items():
+            name = database_name(db)
+            queue_name = os.path.join(self.data, name)
+            queue = self.server.get_queue(queue_name)
+            queue.put(('CINDEX_MANY' if commit else 'INDEX_MANY', (db,), (documents,)))
+        self.sendLine(">> OK")
+        self._init()
+
     @command
     def index(self, line):
         self._index(line, False)
@@ -346,6 +379,24 @@ class XapiandReceiver(CommandReceiver):
     Usage: CINDEX <json>
     """ + index_parser.__doc__
 
+    @command
+    def index_many(self, line):
+        self._index_many(line, False)
+    index_many.__doc__ = """
+    Index several documents at once (each as in INDEX).
+
+    Usage: INDEX_MANY [<json>, ...]
+    """ + index_parser.__doc__
+
+    @command
+    def cindex_many(self, line):
+        self._index_many(line, True)
+    cindex_many.__doc__ = """
+    Index several documents at once and commit.
+
+    Usage: CINDEX_MANY [<json>, ...]
+    """ + index_parser.__doc__
+
     @command(db=True)
     def commit(self, line=''):
         """
@@ -61,6 +61,16 @@ DATABASE_COMMANDS = {
         lambda a: a[0][0],
         dict(commit=True),
     ),
+    'INDEX_MANY': (
+        'index_many',
+        lambda a: '%d documents' % len(a[0]),
+        dict(),
+    ),
+    'CINDEX_MANY': (
+        'index_many',
+        lambda a: '%d documents' % len(a[0]),
+        dict(commit=True),
+    ),
     'DELETE': (
         'delete',
         lambda a: a[0],
@@ -185,7 +195,7 @@ def _writer_loop(databases, databases_pool, db, tq, commit_lock, timeouts, data,
                     last = now
                     _database_command(database, cmd, args, data=data, log=log)
 
-                    if cmd in ('INDEX', 'DELETE'):
+                    if cmd in ('INDEX', 'INDEX_MANY', 'DELETE'):
                         now = time.time()
                         if db in to_commit:
                             to_commit[db] = (to_commit[db][0], to_commit[db][1], now)
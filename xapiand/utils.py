@@ -3,6 +3,9 @@ from __future__ import unicode_literals, absolute_import, division
 import re
 import socket
 import datetime
+import threading
+from functools import wraps
+from collections import OrderedDict
 
 try:
     from dateutil.tz import tzoffset
@@ -15,6 +18,44 @@ except ImportError:
     from urllib import unquote                  # NOQA
     from urlparse import urlparse, parse_qsl    # NOQA
 
+try:
+    from functools import lru_cache
+except ImportError:
+    def lru_cache(maxsize=128):
+        """
+        Least-recently-used cache decorator (a simplified version of Python 3's
+        functools.lru_cache). Arguments must be hashable.
+
+        """
+        def decorator(func):
+            cache = OrderedDict()
+            lock = threading.Lock()
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                key = args + tuple(sorted(kwargs.items())) if kwargs else args
+                with lock:
+                    try:
+                        result = cache.pop(key)
+                        cache[key] = result
+                        return result
+                    except KeyError:
+                        pass
+                result = func(*args, **kwargs)
+                with lock:
+                    cache[key] = result
+                    if maxsize is not None and len(cache) > maxsize:
+                        cache.popitem(last=False)
+                return result
+
+            def cache_clear():
+                with lock:
+                    cache.clear()
+
+            wrapper.cache_clear = cache_clear
+            return wrapper
+        return decorator
+
 
 _MULTIPLE_PATHS = re.compile(r'/{2,}')
 